@@ -0,0 +1,136 @@
+from time import sleep, monotonic
+import tempfile
+import threading
+import unittest
+import io
+import os
+
+from utils.rtmp import StreamFeeder
+
+# 1 KiB is a second of media
+BYTE_RATE = 1024
+
+def probe_duration(file_name):
+    try:
+        return os.path.getsize(file_name) / BYTE_RATE
+    except OSError:
+        return None
+
+class RecordingPipe(io.BytesIO):
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            return super().write(data)
+
+    def getvalue(self):
+        with self._lock:
+            return super().getvalue()
+
+class StreamFeederSwitchTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.stop_event = threading.Event()
+
+    def tearDown(self):
+        self.stop_event.set()
+        self.dir.cleanup()
+
+    def __file(self, name, data):
+        file_name = os.path.join(self.dir.name, name)
+        with open(file_name, "wb") as f:
+            f.write(data)
+        return file_name
+
+    def __wait_for(self, condition, timeout=10):
+        deadline = monotonic() + timeout
+        while monotonic() < deadline:
+            if condition():
+                return True
+            sleep(0.05)
+        return False
+
+    def __start(self, feeder):
+        pipe = RecordingPipe()
+        thread = threading.Thread(target=feeder, args=(pipe, self.stop_event.is_set), daemon=True)
+        thread.start()
+        return pipe, thread
+
+    def __stop(self, thread):
+        self.stop_event.set()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_replacement_source_takes_over_when_new_source_dies_while_buffering(self):
+        a = self.__file("a.ts", b"A" * BYTE_RATE)
+        feeder = StreamFeeder(a, probe_duration, target_lag=2, chunk_size=256)
+        pipe, thread = self.__start(feeder)
+
+        # B dies with less than target_lag buffered so the feeder is stuck in the gap
+        b = self.__file("b.ts", b"B" * (BYTE_RATE // 2))
+        feeder.switch_file(b)
+        self.assertTrue(self.__wait_for(lambda: feeder.get_position()[0] == b))
+        c = self.__file("c.ts", b"C" * (BYTE_RATE * 3))
+        feeder.switch_file(c)
+
+        self.assertTrue(self.__wait_for(lambda: b"C" in pipe.getvalue()))
+        # what B had is still sent before moving on
+        self.assertTrue(pipe.getvalue().startswith(b"A" * BYTE_RATE + b"B" * (BYTE_RATE // 2) + b"C"))
+        self.assertEqual(feeder.get_position()[0], c)
+        self.assertEqual(feeder.pop_finished_files(), [a, b])
+        self.__stop(thread)
+
+    def test_switch_while_previous_next_file_is_pending(self):
+        a = self.__file("a.ts", b"A" * (BYTE_RATE * 2))
+        feeder = StreamFeeder(a, probe_duration, target_lag=1, chunk_size=256)
+        pipe, thread = self.__start(feeder)
+
+        # both are queued while A is still being sent
+        b = self.__file("b.ts", b"B" * (BYTE_RATE * 2))
+        feeder.switch_file(b)
+        c = self.__file("c.ts", b"C" * BYTE_RATE)
+        feeder.switch_file(c)
+        self.assertEqual(feeder.get_position()[3], [b, c])
+        self.assertEqual(feeder.pop_finished_files(), [])
+
+        self.assertTrue(self.__wait_for(lambda: len(pipe.getvalue()) == BYTE_RATE * 5, timeout=15))
+        self.assertEqual(pipe.getvalue(), b"A" * (BYTE_RATE * 2) + b"B" * (BYTE_RATE * 2) + b"C" * BYTE_RATE)
+        self.assertEqual(feeder.pop_finished_files(), [a, b])
+        self.__stop(thread)
+
+class StreamFeederCatchupTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.stop_event = threading.Event()
+
+    def tearDown(self):
+        self.stop_event.set()
+        self.dir.cleanup()
+
+    def __grow(self, file_name):
+        # a live download adding a second of media every second
+        while not self.stop_event.wait(0.25):
+            with open(file_name, "ab") as f:
+                f.write(b"A" * (BYTE_RATE // 4))
+
+    def test_catches_up_to_target_lag_without_flapping(self):
+        file_name = os.path.join(self.dir.name, "a.ts")
+        with open(file_name, "wb") as f:
+            f.write(b"A" * (BYTE_RATE * 5))
+        feeder = StreamFeeder(file_name, probe_duration, target_lag=2, max_rate=2, chunk_size=64)
+        threading.Thread(target=self.__grow, args=(file_name,), daemon=True).start()
+        with self.assertLogs(level="INFO") as logs:
+            thread = threading.Thread(target=feeder, args=(RecordingPipe(), self.stop_event.is_set), daemon=True)
+            thread.start()
+            sleep(7)
+            lag = feeder.get_lag()
+            self.stop_event.set()
+            thread.join(5)
+        flips = [line for line in logs.output if "catching up" in line or "caught up" in line]
+        self.assertEqual(len(flips), 2, flips)
+        self.assertLessEqual(lag, 2.5)
+
+if __name__ == "__main__":
+    unittest.main()
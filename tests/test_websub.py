@@ -0,0 +1,131 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode
+import urllib.request, urllib.error
+import threading
+import hashlib, hmac
+import socket
+import unittest
+
+from utils.websub import WebSubReceiver
+
+CHANNEL_ID = "UCE_M8A5yxnLfW0KghEeajjw"
+SECRET = "hunter2"
+FEED = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns:yt="http://www.youtube.com/xml/schemas/2015" xmlns="http://www.w3.org/2005/Atom">
+  <entry>
+    <yt:videoId>{video_id}</yt:videoId>
+    <yt:channelId>{channel_id}</yt:channelId>
+  </entry>
+</feed>"""
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class HubHandler(BaseHTTPRequestHandler):
+    # Accepts the request then verifies intent with the subscriber asynchronously like a real hub
+    def do_POST(self):
+        params = {k: v[0] for k, v in parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8")).items()}
+        self.send_response(202)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        threading.Thread(target=self.server.hub.verify_intent, args=(params,), daemon=True).start()
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInHub():
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), HubHandler)
+        self.server.hub = self
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/subscribe"
+        # (mode, whether the subscriber echoed the challenge)
+        self.verified = []
+        self.verified_event = threading.Event()
+        self.secret = None
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def verify_intent(self, params):
+        self.secret = params.get("hub.secret")
+        challenge = f"challenge-{len(self.verified)}"
+        query = urlencode({
+            "hub.mode": params["hub.mode"],
+            "hub.topic": params["hub.topic"],
+            "hub.challenge": challenge,
+            "hub.lease_seconds": params["hub.lease_seconds"]
+        })
+        try:
+            with urllib.request.urlopen(f"{params['hub.callback']}?{query}", timeout=5) as res:
+                confirmed = res.read().decode("utf-8") == challenge
+        except urllib.error.HTTPError:
+            confirmed = False
+        self.verified.append((params["hub.mode"], confirmed))
+        self.verified_event.set()
+
+    def publish(self, callback_url, video_id):
+        body = FEED.format(video_id=video_id, channel_id=CHANNEL_ID).encode("utf-8")
+        signature = hmac.new(self.secret.encode("utf-8"), body, hashlib.sha1).hexdigest()
+        request = urllib.request.Request(callback_url, data=body, method="POST", headers={
+            "Content-Type": "application/atom+xml",
+            "X-Hub-Signature": f"sha1={signature}"
+        })
+        with urllib.request.urlopen(request, timeout=5) as res:
+            return res.status
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class WebSubReceiverTest(unittest.TestCase):
+    def setUp(self):
+        self.hub = StandInHub()
+        port = free_port()
+        self.callback_url = f"http://127.0.0.1:{port}/websub"
+        self.receiver = WebSubReceiver([CHANNEL_ID], self.callback_url, host="127.0.0.1", port=port, hub_url=self.hub.url, lease_seconds=3600, secret=SECRET)
+        self.receiver.start()
+        self.assertTrue(self.hub.verified_event.wait(5))
+
+    def tearDown(self):
+        if self.receiver.server is not None:
+            self.receiver.stop(verify_timeout=1)
+        self.hub.close()
+
+    def test_subscribe_notify_and_unsubscribe(self):
+        self.assertEqual(self.hub.verified, [("subscribe", True)])
+        self.assertTrue(self.receiver.is_subscribed(CHANNEL_ID))
+
+        self.assertFalse(self.receiver.wait(0))
+        self.assertEqual(self.hub.publish(self.callback_url, "dQw4w9WgXcQ"), 204)
+        self.assertTrue(self.receiver.wait(5))
+        self.assertEqual(self.receiver.pop_notifications(CHANNEL_ID), {"dQw4w9WgXcQ"})
+        self.assertFalse(self.receiver.wait(0))
+
+        self.hub.verified_event.clear()
+        self.receiver.stop(verify_timeout=5)
+        self.assertTrue(self.hub.verified_event.wait(5))
+        self.assertEqual(self.hub.verified, [("subscribe", True), ("unsubscribe", True)])
+
+    def test_bad_signature_is_dropped(self):
+        self.hub.secret = "wrong"
+        self.assertEqual(self.hub.publish(self.callback_url, "dQw4w9WgXcQ"), 204)
+        self.assertFalse(self.receiver.wait(0.5))
+        self.assertEqual(self.receiver.pop_notifications(CHANNEL_ID), set())
+
+    def test_malformed_requests_get_400(self):
+        for length in ("abc", "-1"):
+            with socket.create_connection(("127.0.0.1", self.receiver.port), timeout=5) as conn:
+                conn.sendall(f"POST /websub HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: {length}\r\nConnection: close\r\n\r\n".encode("utf-8"))
+                self.assertTrue(conn.recv(1024).startswith(b"HTTP/1.0 400"))
+        query = urlencode({
+            "hub.mode": "subscribe",
+            "hub.topic": WebSubReceiver.FEED_URL.format(channel_id=CHANNEL_ID),
+            "hub.challenge": "x",
+            "hub.lease_seconds": "forever"
+        })
+        with self.assertRaises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(f"{self.callback_url}?{query}", timeout=5)
+        self.assertEqual(e.exception.code, 400)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,193 @@
+from time import time
+import os, glob, json
+import fcntl
+import logging
+
+class AdmissionController():
+    # Shared between every restreamer process on the host through state_dir.
+    # Each running restream is a JSON file in state_dir with its priority and bitrate.
+    def __init__(self, state_dir, max_restreams=None, max_egress_kbps=None, max_load=None, load_margin=0.1, shed_cooldown=60, shed_backoff=300, shed_backoff_max=3600):
+        self.state_dir = state_dir
+        self.max_restreams = max_restreams
+        self.max_egress_kbps = max_egress_kbps
+        # 1 minute load average per cpu core
+        self.max_load = max_load
+        # new restreams need the load this far below max_load so they don't push it straight back over
+        self.load_margin = load_margin
+        self.shed_cooldown = shed_cooldown
+        # a shed restream isn't readmitted for shed_backoff seconds, doubling on every shed up to shed_backoff_max
+        self.shed_backoff = shed_backoff
+        self.shed_backoff_max = shed_backoff_max
+        try:
+            os.makedirs(self.state_dir)
+        except FileExistsError:
+            pass
+
+    def __entry_file(self, key):
+        return os.path.join(self.state_dir, f"{key}.json")
+
+    def __backoff_file(self, key):
+        return os.path.join(self.state_dir, f"{key}.backoff")
+
+    def __read_backoff(self, key):
+        try:
+            with open(self.__backoff_file(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def __lock(self):
+        f = open(os.path.join(self.state_dir, ".lock"), "w")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def __read_entries(self):
+        entries = {}
+        for entry_file in glob.glob(os.path.join(self.state_dir, "*.json")):
+            try:
+                with open(entry_file) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                continue
+            # Clean up after processes that exited without releasing
+            if not self.__pid_alive(entry.get("pid")):
+                os.remove(entry_file)
+                continue
+            entries[os.path.basename(entry_file)[:-len(".json")]] = entry
+        # backoffs long over can't affect the next shed's length anymore
+        for backoff_file in glob.glob(os.path.join(self.state_dir, "*.backoff")):
+            try:
+                with open(backoff_file) as f:
+                    expired = time() - json.load(f)["until"] >= self.shed_backoff_max
+            except (OSError, ValueError, KeyError):
+                expired = True
+            if expired:
+                os.remove(backoff_file)
+        return entries
+
+    def __write_entry(self, key, entry):
+        with open(self.__entry_file(key), "w") as f:
+            json.dump(entry, f)
+
+    def __pid_alive(self, pid):
+        if pid is None:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def get_load(self):
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+    def __cpu_saturated(self, margin=0):
+        return self.max_load is not None and self.get_load() >= self.max_load - margin
+
+    def __fits(self, entries, bitrate):
+        if self.max_restreams is not None and len(entries) + 1 > self.max_restreams:
+            return False
+        if self.max_egress_kbps is not None:
+            egress = sum(entry["bitrate"] for entry in entries.values())
+            if egress + bitrate > self.max_egress_kbps:
+                return False
+        return True
+
+    # Whether a restream with bitrate could be admitted at all, even with nothing else running
+    def can_fit(self, bitrate):
+        return self.__fits({}, bitrate)
+
+    # lowest priority first, newest first among equal priorities
+    def __shed_order(self, entries):
+        return sorted(entries.items(), key=lambda item: (item[1]["priority"], -item[1]["started"]))
+
+    def __can_shed(self):
+        last_shed_file = os.path.join(self.state_dir, ".last_shed")
+        try:
+            return time() - os.path.getmtime(last_shed_file) >= self.shed_cooldown
+        except OSError:
+            return True
+
+    def __mark_shed(self, entries, key):
+        entries[key]["shed"] = True
+        self.__write_entry(key, entries[key])
+        with open(os.path.join(self.state_dir, ".last_shed"), "w"):
+            pass
+        # back off longer every time the same restream is shed in a row
+        backoff = self.__read_backoff(key)
+        seconds = self.shed_backoff
+        if backoff is not None and time() - backoff["until"] < self.shed_backoff_max:
+            seconds = min(backoff["seconds"] * 2, self.shed_backoff_max)
+        with open(self.__backoff_file(key), "w") as f:
+            json.dump({"until": time() + seconds, "seconds": seconds}, f)
+        logging.warning(f"Host saturated, shedding restream '{key}' (priority {entries[key]['priority']})")
+
+    # Returns true and registers the restream if the host has room for it.
+    # Otherwise lower priority restreams may be marked to be shed to make room and false is returned,
+    # the caller should try again later
+    def try_admit(self, key, priority, bitrate):
+        lock = self.__lock()
+        try:
+            backoff = self.__read_backoff(key)
+            if backoff is not None and time() < backoff["until"]:
+                return False
+            entries = self.__read_entries()
+            entries.pop(key, None)
+            if self.__fits(entries, bitrate) and not self.__cpu_saturated(self.load_margin):
+                self.__write_entry(key, {
+                    "pid": os.getpid(),
+                    "priority": priority,
+                    "bitrate": bitrate,
+                    "started": time(),
+                    "shed": False
+                })
+                return True
+
+            # See if dropping lower priority restreams would make room
+            remaining = {k: v for k, v in entries.items() if not v["shed"]}
+            victims = []
+            for victim_key, victim in self.__shed_order(remaining):
+                if victim["priority"] >= priority:
+                    break
+                if self.__fits(remaining, bitrate) and (len(victims) > 0 or not self.__cpu_saturated(self.load_margin)):
+                    break
+                victims.append(victim_key)
+                remaining.pop(victim_key)
+            shedding = any(entry["shed"] for entry in entries.values())
+            if len(victims) > 0 and self.__fits(remaining, bitrate) and not shedding and self.__can_shed():
+                for victim_key in victims:
+                    self.__mark_shed(entries, victim_key)
+            return False
+        finally:
+            lock.close()
+
+    def release(self, key):
+        lock = self.__lock()
+        try:
+            os.remove(self.__entry_file(key))
+        except OSError:
+            pass
+        finally:
+            lock.close()
+
+    # Whether the restream should be stopped to make room for higher priority ones
+    def should_shed(self, key):
+        lock = self.__lock()
+        try:
+            entries = self.__read_entries()
+            entry = entries.get(key)
+            if entry is None:
+                return False
+            if entry["shed"]:
+                return True
+            # CPU can saturate after admission, the lowest priority restream goes first
+            if len(entries) > 1 and self.__cpu_saturated() and self.__can_shed():
+                lowest_key = self.__shed_order(entries)[0][0]
+                if lowest_key == key:
+                    self.__mark_shed(entries, key)
+                    return True
+            return False
+        finally:
+            lock.close()
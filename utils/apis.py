@@ -1,16 +1,20 @@
 import os
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+import google.auth.exceptions
 import googleapiclient.discovery
 import googleapiclient.errors
+import httplib2
 import httplib2.error
+import google_auth_httplib2
 import youtube_dl
 import logging
 
 class LiveBroadcast():
-    def __init__(self, broadcast_id, title, channel_id, channel_name="", m3u8_url=None, protocol="m3u8", mine=False):
+    def __init__(self, broadcast_id, title, channel_id, channel_name="", m3u8_url=None, protocol="m3u8", mine=False, bitrate=None, start_time=None):
         self.id = broadcast_id
         self.title = title
         self.m3u8_url = m3u8_url
@@ -20,6 +24,10 @@ class LiveBroadcast():
         self.channel_name = channel_name
         self.protocol = protocol
         self.mine = mine
+        # kbps, None if unknown
+        self.bitrate = bitrate
+        # unix timestamp the broadcast went live, None if unknown
+        self.start_time = start_time
 
 class GoogleApis:
     class NetworkException(Exception):
@@ -36,6 +44,7 @@ class GoogleApis:
         self.api_version = api_version
         self.scopes = scopes
         self.service = None
+        self.credentials = None
 
     def is_authorized(self):
         return self.service is not None
@@ -65,8 +74,14 @@ class GoogleApis:
         self.service = googleapiclient.discovery.build(self.api_name, self.api_version, developerKey=api_key)
 
     def auth_oauth(self, token_file, client_secrets_file, force_new=False):
-        credentials = self.get_credentials(token_file, client_secrets_file, force_new)
-        self.service = googleapiclient.discovery.build(self.api_name, self.api_version, credentials=credentials)
+        self.credentials = self.get_credentials(token_file, client_secrets_file, force_new)
+        self.service = googleapiclient.discovery.build(self.api_name, self.api_version, credentials=self.credentials)
+
+    # httplib2 isn't thread safe so every concurrent request needs its own connection
+    def new_http(self):
+        if self.credentials is None:
+            return httplib2.Http()
+        return google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http())
 
 class YoutubeApis(GoogleApis):
 
@@ -115,7 +130,9 @@ class YoutubeApis(GoogleApis):
                         res_item["title"],
                         channel_id,
                         channel_name=res_item["channel"],
-                        m3u8_url=res_item["url"]
+                        m3u8_url=res_item["url"],
+                        bitrate=res_item.get("tbr"),
+                        start_time=res_item.get("release_timestamp")
                     )
                     livestreams.append(single_stream)
             except youtube_dl.utils.DownloadError as e: 
@@ -150,6 +167,32 @@ class YoutubeApis(GoogleApis):
 
         return res.get("items")[0]
 
+    # Returns (liveBroadcastContent, scheduled start unix timestamp or None) for a video
+    # liveBroadcastContent is one of "upcoming", "live" or "none"
+    def get_live_schedule(self, video_id):
+        if not self.is_authorized():
+            raise GoogleApis.AuthException("Requires OAuth")
+        request = self.service.videos().list(
+            part="snippet,liveStreamingDetails",
+            id=video_id
+        )
+        res = None
+        try:
+            res = request.execute()
+        except googleapiclient.errors.HttpError as e:
+            raise GoogleApis.HttpException(str(e))
+        except httplib2.error.ServerNotFoundError as e:
+            raise GoogleApis.NetworkException(str(e))
+
+        items = res.get("items", [])
+        if len(items) == 0:
+            return ("none", None)
+        broadcast_content = items[0].get("snippet", {}).get("liveBroadcastContent", "none")
+        scheduled_start = items[0].get("liveStreamingDetails", {}).get("scheduledStartTime")
+        if scheduled_start is not None:
+            scheduled_start = datetime.fromisoformat(scheduled_start.replace("Z", "+00:00")).timestamp()
+        return (broadcast_content, scheduled_start)
+
     # Creates the RTMP ingestion point that can be reused for every stream
     def insert_livestream(self, title, fps="variable", resolution="variable"):
         # fps can be "30fps", "60fps"
@@ -258,22 +301,29 @@ class YoutubeApis(GoogleApis):
 
         return res_data
 
-    def list_broadcast(self):
+    def list_broadcast(self, broadcast_status="active"):
         if not self.is_authorized():
             raise GoogleApis.AuthException("Requires OAuth")
-        # acceptable status values: complete, live, testing
-        request =  self.service.liveBroadcasts().list(
+        # acceptable broadcast_status values: active, all, completed, upcoming
+        # 'active' only returns broadcasts that are currently live or testing
+        request = self.service.liveBroadcasts().list(
             part="id,snippet,contentDetails,status",
-            mine=True
+            broadcastStatus=broadcast_status,
+            broadcastType="all",
+            maxResults=50
         )
-        res = None
-        try:
-            res = request.execute()
-        except googleapiclient.errors.HttpError as e:
-            raise GoogleApis.HttpException(str(e))
-        except httplib2.error.ServerNotFoundError as e:
-            raise GoogleApis.NetworkException(str(e))
-        return res.get("items", [])
+        items = []
+        while request is not None:
+            res = None
+            try:
+                res = request.execute()
+            except googleapiclient.errors.HttpError as e:
+                raise GoogleApis.HttpException(str(e))
+            except httplib2.error.ServerNotFoundError as e:
+                raise GoogleApis.NetworkException(str(e))
+            items.extend(res.get("items", []))
+            request = self.service.liveBroadcasts().list_next(request, res)
+        return items
 
     def transition_broadcast(self, broadcast_id, status):
         if not self.is_authorized():
@@ -292,7 +342,51 @@ class YoutubeApis(GoogleApis):
         except httplib2.error.ServerNotFoundError as e:
             raise GoogleApis.NetworkException(str(e))
         return res
-        
+
+    def __transition_broadcast_batch(self, broadcast_ids, status):
+        results = {}
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = None
+            else:
+                results[request_id] = GoogleApis.HttpException(str(exception))
+
+        batch = self.service.new_batch_http_request(callback=callback)
+        for broadcast_id in broadcast_ids:
+            batch.add(self.service.liveBroadcasts().transition(
+                broadcastStatus=status,
+                id=broadcast_id,
+                part="id"
+            ), request_id=broadcast_id)
+        # a failed batch is reported for each of its ids (that didn't get a response already)
+        # instead of raising, so it doesn't take the results of the other batches with it
+        try:
+            batch.execute(http=self.new_http())
+        except googleapiclient.errors.HttpError as e:
+            for broadcast_id in broadcast_ids:
+                results.setdefault(broadcast_id, GoogleApis.HttpException(str(e)))
+        except (httplib2.error.HttpLib2Error, OSError, google.auth.exceptions.GoogleAuthError) as e:
+            # e.g. ServerNotFoundError, socket timeouts, RefreshError
+            for broadcast_id in broadcast_ids:
+                results.setdefault(broadcast_id, GoogleApis.NetworkException(str(e)))
+        return results
+
+    # Transitions many broadcasts using batched requests, at most max_workers batches in flight at once
+    # returns a dict of broadcast id to None if successful, otherwise the exception
+    def transition_broadcasts(self, broadcast_ids, status, batch_size=50, max_workers=4):
+        if not self.is_authorized():
+            raise GoogleApis.AuthException("Requires OAuth")
+        # google limits batches to 50 calls for the youtube api
+        batch_size = max(1, min(batch_size, 50))
+        batches = [broadcast_ids[i:i + batch_size] for i in range(0, len(broadcast_ids), batch_size)]
+        results = {}
+        if len(batches) == 0:
+            return results
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as executor:
+            for batch_results in executor.map(lambda batch: self.__transition_broadcast_batch(batch, status), batches):
+                results.update(batch_results)
+        return results
 
     def bind_broadcast(self, broadcast_id, stream_id):
         if not self.is_authorized():
@@ -1,8 +1,8 @@
-from time import sleep
-import subprocess
+from time import sleep, monotonic
+import subprocess, threading
 import logging
+import os
 
-from .apis import YoutubeApis
 from .utils import SubprocessThread, ellipsize
 
 class RtmpServer():
@@ -13,13 +13,251 @@ class RtmpServer():
     def get_endpoint(self):
         return f"{self.url}/{self.key}"
 
+class RatePacer():
+    # Token bucket for sending bytes at a rate, capped at a second's worth
+    # so time spent waiting on the input isn't sent as a burst later
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.reset()
+
+    def reset(self):
+        self.allowance = 0
+        self.last = monotonic()
+
+    # bytes that can be sent now at rate bytes per second
+    def budget(self, rate):
+        now = monotonic()
+        self.allowance = min(self.allowance + (now - self.last) * rate, rate)
+        self.last = now
+        return int(min(self.allowance, self.chunk_size))
+
+    def spend(self, length):
+        self.allowance -= length
+
+class StreamFeeder():
+    # mpegts packet size, offsets are aligned to this when skipping ahead
+    TS_PACKET_SIZE = 188
+
+    # Writes the buffered stream file into ffmpeg's stdin paced by the file's average byte rate.
+    # While the upload is further than target_lag seconds behind the end of the file it's sent
+    # at up to max_rate times realtime, once it's caught up it goes back to realtime.
+    # The file can be switched for another source's without ffmpeg noticing, the slate_file is
+    # looped while the new source buffers. It's read from the start of every gap so it can be
+    # replaced (atomically) between gaps
+    def __init__(self, stream_file_name, probe_duration, target_lag, max_rate=1, offset=0, byte_rate=None, slate_file=None, lag_tolerance=1, probe_interval=30, chunk_size=65536):
+        self.stream_file_name = stream_file_name
+        self.probe_duration = probe_duration
+        self.target_lag = target_lag
+        self.max_rate = max_rate
+        self.offset = offset
+        self.byte_rate = byte_rate
+        self.slate_file = slate_file
+        self.lag_tolerance = lag_tolerance
+        self.probe_interval = probe_interval
+        self.chunk_size = chunk_size
+        self.catching_up = False
+        # files to continue with in order, and ones already sent that can be deleted
+        self.next_files = []
+        self.finished_files = []
+        self._lock = threading.Lock()
+
+    def __update_byte_rate(self):
+        duration = self.probe_duration(self.stream_file_name)
+        if duration is not None and duration > 0:
+            self.byte_rate = os.path.getsize(self.stream_file_name) / duration
+
+    # seconds of buffered media that haven't been sent yet
+    def get_lag(self):
+        if self.byte_rate is None:
+            return 0
+        return (os.path.getsize(self.stream_file_name) - self.offset) / self.byte_rate
+
+    # drop everything older than target_lag seconds from the end of the file
+    def skip_to_target(self):
+        if self.byte_rate is None:
+            return
+        offset = os.path.getsize(self.stream_file_name) - int(self.target_lag * self.byte_rate)
+        offset -= offset % StreamFeeder.TS_PACKET_SIZE
+        self.offset = max(self.offset, offset)
+
+    # Continue with stream_file_name once the current file and any queued before it are sent.
+    # Every file before it must not grow anymore
+    def switch_file(self, stream_file_name):
+        with self._lock:
+            self.next_files.append(stream_file_name)
+
+    # (current file, byte offset, byte rate, queued files) for carrying on in another feeder
+    def get_position(self):
+        with self._lock:
+            return (self.stream_file_name, self.offset, self.byte_rate, list(self.next_files))
+
+    # Returns and clears the files that have been sent since the last call
+    def pop_finished_files(self):
+        with self._lock:
+            finished_files = self.finished_files
+            self.finished_files = []
+        return finished_files
+
+    def __has_next_file(self):
+        with self._lock:
+            return len(self.next_files) > 0
+
+    # moves to the first queued file if there is one
+    def __take_next_file(self):
+        with self._lock:
+            if len(self.next_files) == 0:
+                return False
+            finished_file = self.stream_file_name
+            self.finished_files.append(finished_file)
+            self.stream_file_name = self.next_files.pop(0)
+            self.offset = 0
+            self.byte_rate = None
+        logging.info(f"Finished uploading '{finished_file}', switching to '{self.stream_file_name}'")
+        return True
+
+    def __write(self, pipe, data):
+        try:
+            pipe.write(data)
+            pipe.flush()
+        except (BrokenPipeError, ValueError, OSError):
+            return False
+        return True
+
+    # returns true when it's time to move to the next file, false if the upload ended
+    def __feed_file(self, pipe, stopped):
+        try:
+            f = open(self.stream_file_name, "rb")
+        except OSError as e:
+            logging.error(f"Unable to open '{self.stream_file_name}' for upload: {e}")
+            return False
+
+        with f:
+            f.seek(self.offset)
+            pacer = RatePacer(self.chunk_size)
+            last_probe = None
+            while not stopped():
+                now = monotonic()
+                if last_probe is None or now - last_probe >= self.probe_interval:
+                    self.__update_byte_rate()
+                    last_probe = now
+                if self.byte_rate is None:
+                    if self.__has_next_file():
+                        # the download ended before there was anything usable in the file
+                        logging.warning(f"Nothing to upload in '{self.stream_file_name}'")
+                        if self.__take_next_file():
+                            return True
+                    # nothing buffered yet to measure, try again soon rather than after probe_interval
+                    pacer.reset()
+                    last_probe = None
+                    sleep(1)
+                    continue
+
+                lag = self.get_lag()
+                # starts once lag_tolerance past the target but doesn't stop until back at it,
+                # so small changes in lag don't keep flipping between the two
+                if self.catching_up:
+                    catching_up = lag > self.target_lag
+                else:
+                    catching_up = self.max_rate > 1 and lag > self.target_lag + self.lag_tolerance
+                if catching_up != self.catching_up:
+                    self.catching_up = catching_up
+                    if catching_up:
+                        logging.info(f"Upload is {lag:.1f}s behind, catching up at up to {self.max_rate}x realtime")
+                    else:
+                        logging.info(f"Upload caught up to {self.target_lag}s delay, returning to realtime")
+
+                length = pacer.budget(self.byte_rate * (self.max_rate if catching_up else 1))
+                if length > 0:
+                    data = f.read(length)
+                    if data:
+                        if not self.__write(pipe, data):
+                            return False
+                        self.offset += len(data)
+                        pacer.spend(len(data))
+                        continue
+                    # only switch once everything from the old source has been sent
+                    if self.__take_next_file():
+                        return True
+                sleep(0.05)
+        return False
+
+    # Loops the slate (if any) until the new file has target_lag seconds buffered
+    def __cover_gap(self, pipe, stopped):
+        slate = None
+        slate_rate = None
+        if self.slate_file is not None:
+            slate_duration = self.probe_duration(self.slate_file)
+            try:
+                if slate_duration is not None and slate_duration > 0:
+                    slate_rate = os.path.getsize(self.slate_file) / slate_duration
+                    slate = open(self.slate_file, "rb")
+            except OSError as e:
+                logging.error(f"Unable to open slate '{self.slate_file}': {e}")
+        if slate is None:
+            logging.info("Holding upload while the new source buffers")
+        else:
+            logging.info(f"Looping '{self.slate_file}' while the new source buffers")
+
+        try:
+            pacer = RatePacer(self.chunk_size)
+            last_probe = None
+            while not stopped():
+                now = monotonic()
+                # the new source can die before it's buffered enough, it won't grow anymore
+                # once another file is queued so send what it has and wait on that one after
+                if self.__has_next_file():
+                    return True
+                if last_probe is None or now - last_probe >= 1:
+                    last_probe = now
+                    duration = self.probe_duration(self.stream_file_name)
+                    if duration is not None and duration >= self.target_lag:
+                        return True
+                if slate is not None:
+                    length = pacer.budget(slate_rate)
+                    if length > 0:
+                        data = slate.read(length)
+                        if not data:
+                            slate.seek(0)
+                            continue
+                        if not self.__write(pipe, data):
+                            return False
+                        pacer.spend(len(data))
+                        continue
+                sleep(0.05)
+        finally:
+            if slate is not None:
+                slate.close()
+        return False
+
+    def __call__(self, pipe, stopped):
+        while self.__feed_file(pipe, stopped):
+            if not self.__cover_gap(pipe, stopped):
+                return
+
 class RtmpRestream():
     class PollException(Exception):
         pass
 
-    def __init__(self, rtmp_server, stream_file_name, input_m3u8, stream_id, delay=10, rtmp_retry_max=3, dl_retry_max=3, log_dir=None, ffmpeg_bin="ffmpeg", ffprobe_bin="ffprobe"):
+    class SwitchException(Exception):
+        pass
+
+    # What the upload is re-encoded to with switchover so every source comes out the same
+    SWITCHOVER_ENCODING = {
+        "width": 1280,
+        "height": 720,
+        "fps": 30,
+        "video_bitrate_kbps": 4500,
+        "audio_bitrate_kbps": 128,
+        "preset": "veryfast"
+    }
+    HELD_CLIP_SECONDS = 5
+
+    def __init__(self, rtmp_server, stream_file_name, input_m3u8, stream_id, delay=10, rtmp_retry_max=3, dl_retry_max=3, log_dir=None, ffmpeg_bin="ffmpeg", ffprobe_bin="ffprobe", catchup_rate=None, catchup_max_lag=300, log_max_bytes=5*1024*1024, log_backup_count=3, log_tail_lines=20, switchover=False, slate_file=None, encoding=None):
         self.rtmp_server = rtmp_server
         self.stream_file_name = stream_file_name
+        # every source (or download restart) gets its own file so the upload can finish the old one
+        self.stream_files = [stream_file_name]
+        self.stream_file_c = 0
         self.input_m3u8 = input_m3u8
         self.stream_id = stream_id
         self.delay = delay
@@ -31,6 +269,24 @@ class RtmpRestream():
         self.rtmp_thread = None
         self.dl_retry_c = 0
         self.rtmp_retry_c = 0
+        # when set the upload resumes where it left off and runs faster than realtime until back at delay
+        self.catchup_rate = catchup_rate
+        self.catchup_max_lag = catchup_max_lag
+        # when set the upload keeps its rtmp connection while the download switches sources
+        self.switchover = switchover
+        self.slate_file = slate_file
+        self.encoding = dict(RtmpRestream.SWITCHOVER_ENCODING)
+        if encoding is not None:
+            self.encoding.update(encoding)
+        # looped by the feeder while a new source buffers, without a slate it's a clip of the last frame sent
+        self.gap_file = slate_file
+        if self.switchover and self.slate_file is None:
+            root, ext = os.path.splitext(stream_file_name)
+            self.gap_file = f"{root}-held{ext}"
+        self.feeder = None
+        self.log_max_bytes = log_max_bytes
+        self.log_backup_count = log_backup_count
+        self.log_tail_lines = log_tail_lines
         self.log_dir = log_dir
         if self.log_dir == "":
             # so we don't accidentially put logs in /
@@ -40,35 +296,190 @@ class RtmpRestream():
                 self.log_dir += "/"
 
 
-    def __ffmpeg_download_stream(self):
+    def __subprocess_thread(self, pargs, log_name, stdin_feeder=None):
         logs = None
         if self.log_dir is not None:
-            logs = f"{self.log_dir}ffmpeg-dl.log"
-        self.dl_thread = SubprocessThread([self.ffmpeg_bin, "-i", self.input_m3u8, "-c", "copy", "-y", self.stream_file_name], logs)
+            # one set of rotated logs per restream so retries and later restreams don't mix
+            logs = f"{self.log_dir}{self.stream_id}-{log_name}.log"
+        return SubprocessThread(pargs, logs,
+            stdin_feeder=stdin_feeder,
+            tail_lines=self.log_tail_lines,
+            log_max_bytes=self.log_max_bytes,
+            log_backup_count=self.log_backup_count,
+            # ffmpeg prints the full output url (including the key) in its errors
+            secrets=[self.rtmp_server.get_endpoint(), self.rtmp_server.key]
+        )
+
+    def __format_log_tail(self, thread):
+        tail = thread.get_log_tail()
+        if len(tail) == 0:
+            return ""
+        return "\n" + "\n".join(f"  {line}" for line in tail)
+
+    def __ffmpeg_download_stream(self):
+        self.dl_thread = self.__subprocess_thread([self.ffmpeg_bin, "-i", self.input_m3u8, "-c", "copy", "-y", self.stream_file_name], "ffmpeg-dl")
         self.dl_thread.start()
 
+    def __probe_duration(self, file_name=None):
+        if file_name is None:
+            file_name = self.stream_file_name
+        ffprobe_duration = subprocess.run(
+            [self.ffprobe_bin, "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", file_name],
+            capture_output=True,
+            encoding='utf-8'
+        )
+        try:
+            return float(ffprobe_duration.stdout.split("\n", 1)[0])
+        except ValueError:
+            return None
+
     def __ffmpeg_send_rtmp(self, seconds_from_end=None):
+        if self.catchup_rate is not None or self.switchover:
+            self.__ffmpeg_send_rtmp_piped()
+            return
+
         pargs = [self.ffmpeg_bin, "-re"]
 
         if seconds_from_end is not None:
             # Get the video duration
-            ffprobe_duration = subprocess.run(
-                [self.ffprobe_bin, "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", self.stream_file_name],
-                capture_output=True,
-                encoding='utf-8'
-            )
-            duration = float(ffprobe_duration.stdout.split("\n", 1)[0])
+            duration = self.__probe_duration()
+            if duration is None:
+                raise RtmpRestream.PollException(f"Unable to get the duration of '{self.stream_file_name}'")
             start_time = duration - seconds_from_end
             logging.info(f"Starting rtmp client for '{self.stream_file_name}' at start time '{start_time}'")
             pargs.extend(["-ss", str(start_time)])
         pargs.extend(["-i", self.stream_file_name, "-c", "copy", "-f", "flv", f"{self.rtmp_server.get_endpoint()}"])
 
-        logs = None
-        if self.log_dir is not None:
-            logs = f"{self.log_dir}ffmpeg-rtmp.log"
-        self.rtmp_thread = SubprocessThread(pargs, logs)
+        self.rtmp_thread = self.__subprocess_thread(pargs, "ffmpeg-rtmp")
         self.rtmp_thread.start()
 
+    def __ffmpeg_send_rtmp_piped(self):
+        # Resume from wherever the last upload got to instead of skipping ahead
+        stream_file_name = self.stream_file_name
+        offset = 0
+        byte_rate = None
+        next_files = []
+        if self.feeder is not None:
+            self.__remove_finished_files()
+            stream_file_name, offset, byte_rate, next_files = self.feeder.get_position()
+        max_rate = 1
+        if self.catchup_rate is not None:
+            max_rate = self.catchup_rate
+        self.feeder = StreamFeeder(stream_file_name, self.__probe_duration, self.delay, max_rate, offset=offset, byte_rate=byte_rate, slate_file=self.gap_file)
+        for next_file in next_files:
+            self.feeder.switch_file(next_file)
+        lag = self.feeder.get_lag()
+        if self.catchup_rate is None or lag > self.catchup_max_lag:
+            if self.catchup_rate is not None:
+                logging.warning(f"Upload is {lag:.1f}s behind which exceeds {self.catchup_max_lag}s, skipping ahead")
+            self.feeder.skip_to_target()
+        logging.info(f"Starting rtmp client for '{stream_file_name}' at byte offset '{self.feeder.offset}'")
+        # pacing is done by the feeder so ffmpeg reads stdin as fast as it's given
+        pargs = [self.ffmpeg_bin]
+        if self.switchover:
+            # Sources spliced together have unrelated timestamps and codec parameters.
+            # ffmpeg already removes timestamp jumps in mpegts input over dts_delta_threshold seconds
+            # (and any going backwards), the lower threshold catches short ones too.
+            # Re-encoding decodes through parameter changes and keeps the output format fixed
+            pargs.extend(["-dts_delta_threshold", "1", "-i", "pipe:0"])
+            pargs.extend(self.__encoding_args())
+        else:
+            pargs.extend(["-i", "pipe:0", "-c", "copy"])
+        pargs.extend(["-f", "flv", f"{self.rtmp_server.get_endpoint()}"])
+
+        self.rtmp_thread = self.__subprocess_thread(pargs, "ffmpeg-rtmp", stdin_feeder=self.feeder)
+        self.rtmp_thread.start()
+
+    # scales into the output size, letterboxing sources with another aspect ratio
+    def __scale_filter(self):
+        width = self.encoding["width"]
+        height = self.encoding["height"]
+        return f"scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1"
+
+    def __encoding_args(self):
+        video_bitrate = self.encoding["video_bitrate_kbps"]
+        return [
+            "-vf", f"fps={self.encoding['fps']},{self.__scale_filter()}",
+            # every source is resampled to one rate, async keeps the audio in step with the timestamps
+            "-af", "aresample=48000:async=1",
+            "-c:v", "libx264", "-preset", self.encoding["preset"], "-pix_fmt", "yuv420p",
+            "-g", str(self.encoding["fps"] * 2),
+            "-b:v", f"{video_bitrate}k", "-maxrate", f"{video_bitrate}k", "-bufsize", f"{video_bitrate * 2}k",
+            "-c:a", "aac", "-b:a", f"{self.encoding['audio_bitrate_kbps']}k", "-ar", "48000"
+        ]
+
+    # Replaces the held clip with the last frame of stream_file_name, the download has to be stopped.
+    # Files are uploaded in order so that's the last frame sent before the next gap
+    def __make_held_clip(self, stream_file_name):
+        root, ext = os.path.splitext(self.gap_file)
+        frame_file = f"{root}.png"
+        clip_file = f"{root}.tmp{ext}"
+        # -update keeps overwriting the image so the last decoded frame is what's left
+        frame = subprocess.run(
+            [self.ffmpeg_bin, "-v", "error", "-sseof", "-1", "-i", stream_file_name, "-update", "1", "-y", frame_file],
+            capture_output=True,
+            encoding="utf-8"
+        )
+        result = frame
+        if frame.returncode == 0:
+            result = subprocess.run(
+                [self.ffmpeg_bin, "-v", "error",
+                    "-loop", "1", "-framerate", str(self.encoding["fps"]), "-i", frame_file,
+                    "-f", "lavfi", "-i", "anullsrc=r=48000:cl=stereo",
+                    "-t", str(RtmpRestream.HELD_CLIP_SECONDS), "-vf", self.__scale_filter(),
+                    "-c:v", "libx264", "-preset", "ultrafast", "-tune", "stillimage", "-pix_fmt", "yuv420p",
+                    "-c:a", "aac", "-f", "mpegts", "-y", clip_file],
+                capture_output=True,
+                encoding="utf-8"
+            )
+        self.__remove_stream_file(frame_file)
+        if result.returncode != 0:
+            self.__remove_stream_file(clip_file)
+            logging.warning(f"Unable to hold the last frame of '{stream_file_name}': {result.stderr.strip()}")
+            return
+        # the feeder may be about to open it
+        os.replace(clip_file, self.gap_file)
+
+    def __remove_stream_file(self, stream_file_name):
+        try:
+            os.remove(stream_file_name)
+        except OSError:
+            pass
+
+    # files the upload has sent aren't needed anymore, the first is left for the caller like without switchover
+    def __remove_finished_files(self):
+        for stream_file_name in self.feeder.pop_finished_files():
+            if stream_file_name != self.stream_files[0]:
+                self.__remove_stream_file(stream_file_name)
+                self.stream_files.remove(stream_file_name)
+
+    # Restarts the download into a new file which the upload moves to once it's sent the ones before it
+    def __switch_download(self):
+        if self.dl_thread is not None:
+            self.dl_thread.stop()
+            self.dl_thread.join()
+        if self.gap_file is not None and self.gap_file != self.slate_file:
+            self.__make_held_clip(self.stream_file_name)
+        self.__remove_finished_files()
+
+        self.stream_file_c += 1
+        root, ext = os.path.splitext(self.stream_files[0])
+        self.stream_file_name = f"{root}-{self.stream_file_c}{ext}"
+        self.__remove_stream_file(self.stream_file_name)
+        self.stream_files.append(self.stream_file_name)
+        self.__ffmpeg_download_stream()
+        self.feeder.switch_file(self.stream_file_name)
+
+    # Moves the download to a new source while the upload keeps its rtmp connection (and broadcast)
+    def switch_source(self, input_m3u8, stream_id):
+        if self.feeder is None:
+            raise RtmpRestream.SwitchException("Switching sources requires the piped upload, enable 'restream_switchover'")
+        logging.info(f"Switching restream source from '{self.stream_id}' to '{stream_id}'")
+        self.input_m3u8 = input_m3u8
+        self.stream_id = stream_id
+        self.dl_retry_c = 0
+        self.__switch_download()
+
     def start(self):
         logging.info("Creating thread with ffmpeg downloader")
         self.__ffmpeg_download_stream()
@@ -88,24 +499,47 @@ class RtmpRestream():
             self.rtmp_thread.stop()
             self.rtmp_thread.join()
             self.rtmp_thread = None
+        # the first file is left for the caller like without switchover, the feeder has stopped
+        # with the upload so none of them are being read anymore
+        for stream_file_name in self.stream_files[1:]:
+            self.__remove_stream_file(stream_file_name)
+        self.stream_files = self.stream_files[:1]
+        if self.gap_file is not None and self.gap_file != self.slate_file:
+            self.__remove_stream_file(self.gap_file)
+
+    # (thread, seconds from spawning the upload ffmpeg to its first frame, monotonic time of the first frame)
+    # once media is flowing, otherwise None
+    def get_upload_connect(self):
+        if self.rtmp_thread is None:
+            return None
+        first_progress = self.rtmp_thread.get_first_progress()
+        if first_progress is None:
+            return None
+        return (self.rtmp_thread, first_progress - self.rtmp_thread.started_at, first_progress)
 
     # gives the status of the subprocess threads
     # returns true if running, false if exited normally
     def poll(self):
+        if self.feeder is not None:
+            self.__remove_finished_files()
         if not self.dl_thread.is_alive():
             self.dl_thread.join()
-            logging.warning(f"Restream :{self.stream_id}': source stream download failed")
+            logging.warning(f"Restream :{self.stream_id}': source stream download failed{self.__format_log_tail(self.dl_thread)}")
             if self.dl_retry_c >= self.dl_retry_max:
                 raise RtmpRestream.PollException(f"Exceeded '{self.dl_retry_max}' max restart attempts for source stream download")
             else:
                 logging.warning(f"->Retrying {self.dl_retry_c + 1}/{self.dl_retry_max}")
-                self.__ffmpeg_download_stream()
+                if self.feeder is not None:
+                    # restarting into the same file would overwrite what the upload is reading
+                    self.__switch_download()
+                else:
+                    self.__ffmpeg_download_stream()
                 self.dl_retry_c += 1
                 return True
         
         if not self.rtmp_thread.is_alive():
             self.rtmp_thread.join()
-            logging.warning(f"Restream :{self.stream_id}': restream upload failed")
+            logging.warning(f"Restream :{self.stream_id}': restream upload failed{self.__format_log_tail(self.rtmp_thread)}")
             if self.rtmp_retry_c >= self.rtmp_retry_max:
                 raise RtmpRestream.PollException(f"Exceeded '{self.rtmp_retry_max}' max restart attempts for restream upload")
             else:
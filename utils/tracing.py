@@ -0,0 +1,134 @@
+from time import monotonic
+from datetime import datetime
+from contextlib import contextmanager
+import urllib.request, urllib.error
+import threading
+import json
+import logging
+
+class LatencyHistogram():
+    # upper bounds in seconds, anything slower goes in the last bucket
+    BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+    def __init__(self):
+        self.counts = [0] * (len(LatencyHistogram.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(LatencyHistogram.BUCKETS) and seconds > LatencyHistogram.BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    # upper bound of the bucket the percentile falls in
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+        target = p / 100 * self.count
+        total = 0
+        for i, count in enumerate(self.counts):
+            total += count
+            if total >= target:
+                if i < len(LatencyHistogram.BUCKETS):
+                    return min(LatencyHistogram.BUCKETS[i], self.max)
+                return self.max
+        return self.max
+
+    def to_dict(self):
+        buckets = {f"<={bound}": count for bound, count in zip(LatencyHistogram.BUCKETS, self.counts)}
+        buckets[f">{LatencyHistogram.BUCKETS[-1]}"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.sum / self.count if self.count > 0 else None,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "buckets": buckets
+        }
+
+class Tracer():
+    # Records how long each named phase takes into a histogram per name.
+    # output is a JSON file path or an http(s) endpoint the histograms are POSTed to every interval seconds
+    def __init__(self, output=None, interval=60):
+        self.output = output
+        self.interval = interval
+        self.histograms = {}
+        # name -> monotonic start of spans that are ended later
+        self.open_spans = {}
+        self.last_write = monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        logging.debug(f"Span '{name}' took {seconds:.3f}s")
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram()
+            self.histograms[name].observe(seconds)
+
+    @contextmanager
+    def span(self, name):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, monotonic() - start)
+
+    # For phases that span several loop iterations, starting an already open span keeps the original start
+    def start(self, name, start=None):
+        if name not in self.open_spans:
+            self.open_spans[name] = monotonic() if start is None else start
+
+    def end(self, name, end=None):
+        start = self.open_spans.pop(name, None)
+        if start is None:
+            return
+        self.record(name, (monotonic() if end is None else end) - start)
+
+    def cancel(self, name):
+        self.open_spans.pop(name, None)
+
+    def is_open(self, name):
+        return name in self.open_spans
+
+    def to_dict(self):
+        with self._lock:
+            spans = {name: histogram.to_dict() for name, histogram in self.histograms.items()}
+        return {
+            "generated": datetime.utcnow().isoformat(),
+            "spans": spans
+        }
+
+    def write(self):
+        self.last_write = monotonic()
+        if self.output is None:
+            return
+        data = json.dumps(self.to_dict(), indent=4)
+        if self.output.startswith("http://") or self.output.startswith("https://"):
+            request = urllib.request.Request(self.output, data=data.encode("utf-8"), headers={"Content-Type": "application/json"}, method="POST")
+            try:
+                with urllib.request.urlopen(request, timeout=10) as res:
+                    res.read()
+            except (urllib.error.URLError, OSError) as e:
+                logging.warning(f"Failed to send latency histograms to '{self.output}': {str(e)}")
+        else:
+            try:
+                with open(self.output, "w") as f:
+                    f.write(data)
+            except OSError as e:
+                logging.warning(f"Failed to write latency histograms to '{self.output}': {str(e)}")
+
+    def maybe_write(self):
+        if monotonic() - self.last_write >= self.interval:
+            self.write()
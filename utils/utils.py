@@ -1,9 +1,11 @@
-from time import sleep
+from time import sleep, monotonic
 import subprocess, threading
 import re
 import sys
 import os, glob
 import logging
+import logging.handlers
+from collections import deque
 
 class LoggingLevel:
     LEVELS = {
@@ -37,22 +39,105 @@ def youtube_link_to_id(link):
             video_id = video_id_m
     return video_id
 
-def remove_dir_contents(dir):
-    g = glob.glob(f"{dir}/*")
-    g_hidden = glob.glob(f"{dir}/.*")
-    g.extend(g_hidden)
-    for f in g:
-        os.remove(f)
+# Log files are named '[restream]-[process].log' plus rotated '.log.N' copies,
+# only the logs of the keep most recently written restreams are kept
+def prune_log_dir(dir, keep, separator="-ffmpeg-"):
+    groups = {}
+    for f in glob.glob(os.path.join(dir, f"*{separator}*.log*")):
+        restream = os.path.basename(f).split(separator, 1)[0]
+        try:
+            mtime = os.path.getmtime(f)
+        except OSError:
+            continue
+        files, newest = groups.get(restream, ([], 0))
+        files.append(f)
+        groups[restream] = (files, max(newest, mtime))
+    by_newest = sorted(groups.values(), key=lambda group: group[1], reverse=True)
+    for files, newest in by_newest[keep:]:
+        for f in files:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+def redact(text, secrets, replacement="<redacted>"):
+    for secret in secrets:
+        if secret:
+            text = text.replace(secret, replacement)
+    return text
+
+class OutputCapture(threading.Thread):
+    LINE_SPLIT = re.compile(rb"[\r\n]+")
+
+    # Drains a subprocess pipe on its own thread so the process never blocks on a full pipe.
+    # Lines are written to a size rotated logfile (if given) and the last tail_lines are kept in memory,
+    # secrets are redacted from both
+    def __init__(self, pipe, logfile=None, tail_lines=20, max_bytes=5*1024*1024, backup_count=3, header=None, secrets=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.pipe = pipe
+        self.secrets = secrets or []
+        self.tail = deque(maxlen=tail_lines)
+        # monotonic time of the first ffmpeg progress line, i.e. when media started flowing
+        self.first_progress = None
+        self.handler = None
+        if logfile is not None:
+            self.handler = logging.handlers.RotatingFileHandler(logfile, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+            self.handler.setFormatter(logging.Formatter("%(message)s"))
+            if header is not None:
+                self.__write(redact(header, self.secrets))
+
+    def __write(self, line):
+        if self.handler is not None:
+            self.handler.handle(logging.makeLogRecord({"msg": line}))
+
+    def __line(self, raw):
+        line = redact(raw.decode("utf-8", errors="replace").rstrip(), self.secrets)
+        if line:
+            if self.first_progress is None and (line.startswith("frame=") or line.startswith("size=")):
+                self.first_progress = monotonic()
+            self.tail.append(line)
+            self.__write(line)
+
+    def run(self):
+        buf = b""
+        try:
+            while True:
+                # ffmpeg ends progress lines with \r so read whatever is available instead of readline
+                data = self.pipe.read1(4096)
+                if not data:
+                    break
+                lines = OutputCapture.LINE_SPLIT.split(buf + data)
+                buf = lines.pop()
+                for raw in lines:
+                    self.__line(raw)
+            self.__line(buf)
+        except (OSError, ValueError):
+            pass
+        finally:
+            if self.handler is not None:
+                self.handler.close()
+
+    def get_tail(self):
+        return list(self.tail)
 
 class SubprocessThread(threading.Thread):
     class RunException(Exception):
         pass
 
-    def __init__(self, pargs, logfile=None):
+    def __init__(self, pargs, logfile=None, stdin_feeder=None, tail_lines=20, log_max_bytes=5*1024*1024, log_backup_count=3, secrets=None):
         threading.Thread.__init__(self)
         self._stop_event = threading.Event()
         self.pargs = pargs
         self.logfile = logfile
+        # callable(pipe, stopped) that writes the subprocess input
+        self.stdin_feeder = stdin_feeder
+        self.tail_lines = tail_lines
+        self.log_max_bytes = log_max_bytes
+        self.log_backup_count = log_backup_count
+        # strings (e.g. stream keys) kept out of the console and log files
+        self.secrets = secrets or []
+        self.capture = None
+        self.started_at = None
         self.returncode = -1
 
     def stop(self):
@@ -61,25 +146,44 @@ class SubprocessThread(threading.Thread):
     def stopped(self):
         return self._stop_event.is_set()
 
+    def __feed(self, popen):
+        # the feeder would otherwise keep going until a write fails after the process exits by itself
+        def feeding_stopped():
+            return self.stopped() or popen.poll() is not None
+
+        try:
+            self.stdin_feeder(popen.stdin, feeding_stopped)
+        finally:
+            try:
+                popen.stdin.close()
+            except OSError:
+                pass
+
     def proc(self):
-        popen = None
-        f = None
-        if self.logfile is None:
-            popen = subprocess.Popen(self.pargs, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        else:
-            f = open(self.logfile, "a")
-            f.write(f"{str(self.pargs)}\n")
-            f.flush()
-            popen = subprocess.Popen(self.pargs, stdout=f, stderr=subprocess.STDOUT, universal_newlines=True)
+        stdin = None
+        if self.stdin_feeder is not None:
+            stdin = subprocess.PIPE
+        self.started_at = monotonic()
+        popen = subprocess.Popen(self.pargs, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.capture = OutputCapture(popen.stdout, self.logfile,
+            tail_lines=self.tail_lines,
+            max_bytes=self.log_max_bytes,
+            backup_count=self.log_backup_count,
+            header=str(self.pargs),
+            secrets=self.secrets
+        )
+        self.capture.start()
+        if self.stdin_feeder is not None:
+            threading.Thread(target=self.__feed, args=(popen,), daemon=True).start()
 
         while True:
             if self.stopped():
                 popen.terminate()
             if popen.poll() is not None: 
-                if f is not None:
-                    f.close() 
+                self.capture.join()
+                popen.stdout.close()
                 self.returncode = popen.returncode
-                logging.warning(f"Process '{ellipsize(pargs_to_cmd(self.pargs), 75)}' exited with code {self.returncode}")
+                logging.warning(f"Process '{ellipsize(redact(pargs_to_cmd(self.pargs), self.secrets), 75)}' exited with code {self.returncode}")
                 return
             sleep(1)
 
@@ -87,4 +191,16 @@ class SubprocessThread(threading.Thread):
         self.proc()
     
     def get_return_code(self):
-        return self.returncode
\ No newline at end of file
+        return self.returncode
+
+    # monotonic time the process first reported progress, None if it hasn't yet
+    def get_first_progress(self):
+        if self.capture is None:
+            return None
+        return self.capture.first_progress
+
+    # last lines of output, useful for explaining why the process exited
+    def get_log_tail(self):
+        if self.capture is None:
+            return []
+        return self.capture.get_tail()
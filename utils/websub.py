@@ -0,0 +1,241 @@
+from time import monotonic
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
+import urllib.request, urllib.error
+import xml.etree.ElementTree as ET
+import threading
+import hashlib, hmac
+import logging
+
+class WebSubHandler(BaseHTTPRequestHandler):
+    def __respond(self, code, body=b""):
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Hub verifying a subscribe/unsubscribe request
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        mode = query.get("hub.mode", [None])[0]
+        topic = query.get("hub.topic", [None])[0]
+        challenge = query.get("hub.challenge", [None])[0]
+        lease_seconds = query.get("hub.lease_seconds", [None])[0]
+        if lease_seconds is not None:
+            try:
+                lease_seconds = int(lease_seconds)
+            except ValueError:
+                self.__respond(400)
+                return
+        if challenge is None or not self.server.receiver.verify(mode, topic, lease_seconds):
+            self.__respond(404)
+            return
+        self.__respond(200, challenge.encode("utf-8"))
+
+    # Hub delivering a feed update
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.__respond(400)
+            return
+        body = self.rfile.read(length)
+        # Always acknowledge so the hub doesn't keep retrying, bad payloads are just dropped
+        self.__respond(204)
+        self.server.receiver.notify(body, self.headers.get("X-Hub-Signature"))
+
+    def log_message(self, format, *args):
+        logging.debug(f"WebSub {self.address_string()} {format % args}")
+
+class WebSubReceiver():
+    class SubscribeException(Exception):
+        pass
+
+    YOUTUBE_HUB_URL = "https://pubsubhubbub.appspot.com/subscribe"
+    FEED_URL = "https://www.youtube.com/xml/feeds/videos.xml?channel_id={channel_id}"
+    FEED_NS = {
+        "atom": "http://www.w3.org/2005/Atom",
+        "yt": "http://www.youtube.com/xml/schemas/2015"
+    }
+
+    # Receives YouTube upload notifications for channel_ids through a WebSub (PubSubHubbub) hub.
+    # callback_url is the address the hub can reach the built-in server on (host:port) at
+    def __init__(self, channel_ids, callback_url, host="0.0.0.0", port=8080, hub_url=YOUTUBE_HUB_URL, lease_seconds=86400, secret=None, retry_interval=300):
+        self.callback_url = callback_url
+        self.host = host
+        self.port = port
+        self.hub_url = hub_url
+        self.lease_seconds = lease_seconds
+        self.secret = secret
+        self.retry_interval = retry_interval
+        self.topics = {WebSubReceiver.FEED_URL.format(channel_id=channel_id): channel_id for channel_id in channel_ids}
+        # topic -> monotonic time the lease expires, None until the hub verifies it
+        self.lease_expiry = {topic: None for topic in self.topics}
+        # topic -> monotonic time of the last subscribe request
+        self.requested = {}
+        # channel_id -> video ids notified since the last pop_notifications
+        self.notified_videos = {}
+        # topics waiting on the hub to verify an unsubscribe
+        self.unsubscribing = set()
+        self._unsubscribed_event = threading.Event()
+        self._lock = threading.Lock()
+        self._notify_event = threading.Event()
+        self._stop_event = threading.Event()
+        self.server = None
+        self.server_thread = None
+        self.renew_thread = None
+
+    def start(self):
+        self.server = ThreadingHTTPServer((self.host, self.port), WebSubHandler)
+        self.server.daemon_threads = True
+        self.server.receiver = self
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        logging.info(f"WebSub callback listening on {self.host}:{self.port}")
+        self.renew_thread = threading.Thread(target=self.__renew_loop, daemon=True)
+        self.renew_thread.start()
+
+    # Unsubscribing is verified asynchronously by the hub calling back, so the server
+    # stays up for up to verify_timeout seconds. Otherwise the lease just expires
+    def stop(self, verify_timeout=10):
+        self._stop_event.set()
+        with self._lock:
+            self.unsubscribing = set(self.topics)
+        for topic in self.topics:
+            try:
+                self.__hub_request(topic, "unsubscribe")
+            except WebSubReceiver.SubscribeException as e:
+                logging.warning(e)
+                self.__unsubscribed(topic)
+        if not self._unsubscribed_event.wait(verify_timeout):
+            logging.warning("Hub didn't verify unsubscribing in time, the subscription will expire with its lease")
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __hub_request(self, topic, mode):
+        params = {
+            "hub.callback": self.callback_url,
+            "hub.mode": mode,
+            "hub.topic": topic,
+            "hub.verify": "async",
+            "hub.lease_seconds": str(self.lease_seconds)
+        }
+        if self.secret is not None:
+            params["hub.secret"] = self.secret
+        request = urllib.request.Request(self.hub_url, data=urlencode(params).encode("utf-8"), method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=30) as res:
+                res.read()
+        except (urllib.error.URLError, OSError) as e:
+            raise WebSubReceiver.SubscribeException(f"WebSub {mode} for '{topic}' failed: {str(e)}")
+
+    def __unsubscribed(self, topic):
+        with self._lock:
+            self.unsubscribing.discard(topic)
+            if len(self.unsubscribing) == 0:
+                self._unsubscribed_event.set()
+
+    def subscribe(self, topic):
+        with self._lock:
+            self.requested[topic] = monotonic()
+        logging.info(f"Subscribing to WebSub notifications for channel '{self.topics[topic]}'")
+        self.__hub_request(topic, "subscribe")
+
+    def __needs_subscribe(self, topic, now):
+        expiry = self.lease_expiry[topic]
+        requested = self.requested.get(topic)
+        if requested is not None and now - requested < self.retry_interval:
+            # still waiting on the hub to verify
+            if expiry is None or expiry > now:
+                return False
+        if expiry is None:
+            return True
+        # renew with a tenth of the lease left, at most an hour early
+        return expiry - now < min(self.lease_seconds / 10, 3600)
+
+    def __renew_loop(self):
+        while not self._stop_event.is_set():
+            now = monotonic()
+            for topic in self.topics:
+                with self._lock:
+                    needs_subscribe = self.__needs_subscribe(topic, now)
+                if needs_subscribe:
+                    try:
+                        self.subscribe(topic)
+                    except WebSubReceiver.SubscribeException as e:
+                        logging.error(e)
+            self._stop_event.wait(60)
+
+    # Called by the handler when the hub verifies intent (lease_seconds is an int or None), returns whether to confirm
+    def verify(self, mode, topic, lease_seconds):
+        if topic not in self.topics:
+            return False
+        if mode == "subscribe":
+            if lease_seconds is None:
+                lease_seconds = self.lease_seconds
+            with self._lock:
+                self.lease_expiry[topic] = monotonic() + lease_seconds
+            logging.info(f"WebSub subscription for channel '{self.topics[topic]}' verified for {lease_seconds} seconds")
+            return True
+        if mode == "unsubscribe":
+            # only confirm unsubscribes we asked for
+            with self._lock:
+                requested = topic in self.unsubscribing
+            if requested:
+                self.__unsubscribed(topic)
+            return requested
+        return False
+
+    def __signature_valid(self, body, signature):
+        if self.secret is None:
+            return True
+        if signature is None or "=" not in signature:
+            return False
+        method, digest = signature.split("=", 1)
+        if method not in hashlib.algorithms_available:
+            return False
+        expected = hmac.new(self.secret.encode("utf-8"), body, method).hexdigest()
+        return hmac.compare_digest(expected, digest)
+
+    # Called by the handler with a feed update
+    def notify(self, body, signature=None):
+        if not self.__signature_valid(body, signature):
+            logging.warning("Dropped WebSub notification with invalid signature")
+            return
+        try:
+            feed = ET.fromstring(body)
+        except ET.ParseError:
+            logging.warning("Dropped WebSub notification that isn't valid XML")
+            return
+        notified = False
+        for entry in feed.findall("atom:entry", WebSubReceiver.FEED_NS):
+            channel_id = entry.findtext("yt:channelId", namespaces=WebSubReceiver.FEED_NS)
+            video_id = entry.findtext("yt:videoId", namespaces=WebSubReceiver.FEED_NS)
+            if channel_id in self.topics.values() and video_id is not None:
+                logging.info(f"WebSub notification for video '{video_id}' on channel '{channel_id}'")
+                with self._lock:
+                    self.notified_videos.setdefault(channel_id, set()).add(video_id)
+                notified = True
+        if notified:
+            self._notify_event.set()
+
+    # Blocks for up to timeout seconds, returns early with True if a notification arrived
+    def wait(self, timeout):
+        return self._notify_event.wait(timeout)
+
+    # Returns and clears the video ids notified for channel_id since the last call
+    def pop_notifications(self, channel_id):
+        with self._lock:
+            video_ids = self.notified_videos.pop(channel_id, set())
+            if len(self.notified_videos) == 0:
+                self._notify_event.clear()
+        return video_ids
+
+    def is_subscribed(self, channel_id):
+        topic = WebSubReceiver.FEED_URL.format(channel_id=channel_id)
+        expiry = self.lease_expiry.get(topic)
+        return expiry is not None and expiry > monotonic()
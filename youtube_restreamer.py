@@ -1,11 +1,15 @@
-import os, json
+import os, json, glob
 from argparse import ArgumentParser
-from time import sleep
+from time import sleep, time, monotonic
+import cProfile
 import logging
 
 from utils.apis import YoutubeApis, GoogleApis
-from utils.utils import SubprocessThread, ellipsize, youtube_link_to_id, remove_dir_contents, LoggingLevel
+from utils.utils import SubprocessThread, ellipsize, youtube_link_to_id, prune_log_dir, LoggingLevel
 from utils.rtmp import RtmpServer, RtmpRestream, YoutubeRestream
+from utils.websub import WebSubReceiver
+from utils.admission import AdmissionController
+from utils.tracing import Tracer
 
 class Restreamer():
     class ValidateOptionsException(Exception):
@@ -36,6 +40,38 @@ class Restreamer():
             options["ffmpeg_bin"] = "ffmpeg"
         if "ffmpeg_log_dir" not in options:
             options["ffmpeg_log_dir"] = None
+        if "ffmpeg_log_max_bytes" not in options:
+            options["ffmpeg_log_max_bytes"] = 5 * 1024 * 1024
+        if "ffmpeg_log_backup_count" not in options:
+            options["ffmpeg_log_backup_count"] = 3
+        if "ffmpeg_log_keep_restreams" not in options:
+            options["ffmpeg_log_keep_restreams"] = 10
+        if "ffmpeg_log_tail_lines" not in options:
+            options["ffmpeg_log_tail_lines"] = 20
+        if "broadcast_batch_size" not in options:
+            options["broadcast_batch_size"] = 50
+        if "broadcast_batch_workers" not in options:
+            options["broadcast_batch_workers"] = 4
+        if "restream_catchup_rate" not in options:
+            options["restream_catchup_rate"] = None
+        elif options["restream_catchup_rate"] is not None:
+            if options["restream_catchup_rate"] <= 1:
+                raise Restreamer.ValidateOptionsException("'restream_catchup_rate' must be greater than 1")
+        if "restream_switchover" not in options:
+            options["restream_switchover"] = False
+        if "restream_slate_file" not in options:
+            options["restream_slate_file"] = None
+        if "restream_switchover_encoding" not in options:
+            options["restream_switchover_encoding"] = {}
+        for key, value in RtmpRestream.SWITCHOVER_ENCODING.items():
+            if key not in options["restream_switchover_encoding"]:
+                options["restream_switchover_encoding"][key] = value
+        if options["restream_catchup_rate"] is not None or options["restream_switchover"]:
+            # The upload is fed through a pipe so the buffer has to be a streamable format
+            if not options.get("stream_file_name", "stream.ts").endswith(".ts"):
+                raise Restreamer.ValidateOptionsException("'restream_catchup_rate' and 'restream_switchover' require a '.ts' 'stream_file_name'")
+        if "restream_catchup_max_lag" not in options:
+            options["restream_catchup_max_lag"] = 300
         if "ffprobe_bin" not in options:
             options["ffprobe_bin"] = "ffprobe"
         else:
@@ -43,6 +79,51 @@ class Restreamer():
             if not options["restream_privacy"] in ["public", "private", "unlisted"]:
                 raise Restreamer.ValidateOptionsException(f"Invalid value '{options['restream_privacy']}' for 'restream_privacy'")
         
+        if "websub" not in options:
+            options["websub"] = None
+        else:
+            if "callback_url" not in options["websub"]:
+                raise Restreamer.ValidateOptionsException("Missing required field 'callback_url' in 'websub'")
+            websub_defaults = {
+                "host": "0.0.0.0",
+                "port": 8080,
+                "hub_url": WebSubReceiver.YOUTUBE_HUB_URL,
+                "lease_seconds": 86400,
+                "secret": None,
+                "fallback_search_interval": 1800,
+                "pending_timeout": 3600,
+                "pending_grace": 900
+            }
+            for key, value in websub_defaults.items():
+                if key not in options["websub"]:
+                    options["websub"][key] = value
+
+        if "priority" not in options:
+            options["priority"] = 0
+        if "admission" not in options:
+            options["admission"] = None
+        else:
+            admission_defaults = {
+                "state_dir": "/tmp/youtube-restreamer",
+                "max_restreams": None,
+                "max_egress_kbps": None,
+                "max_load": None,
+                "load_margin": 0.1,
+                "shed_backoff": 300,
+                "bitrate_estimate": 6000,
+                "queue": True
+            }
+            for key, value in admission_defaults.items():
+                if key not in options["admission"]:
+                    options["admission"][key] = value
+
+        if "tracing" not in options:
+            options["tracing"] = {}
+        if "output" not in options["tracing"]:
+            options["tracing"]["output"] = None
+        if "interval" not in options["tracing"]:
+            options["tracing"]["interval"] = 60
+
         # Required
         if "channel_id" not in options:
             raise Restreamer.ValidateOptionsException("Missing required field 'channel_id'")
@@ -63,25 +144,162 @@ class Restreamer():
         self.options = options
         self.finished_stream_ids = []
         self.__validate_options(self.options)
+        self.websub = None
+        # notified video id -> unix time to stop polling for it going live
+        self.pending_videos = {}
+        self.tracer = Tracer(self.options["tracing"]["output"], self.options["tracing"]["interval"])
+        self.admission = None
+        if self.options["admission"] is not None:
+            admission_options = self.options["admission"]
+            self.admission = AdmissionController(admission_options["state_dir"],
+                max_restreams=admission_options["max_restreams"],
+                max_egress_kbps=admission_options["max_egress_kbps"],
+                max_load=admission_options["max_load"],
+                load_margin=admission_options["load_margin"],
+                shed_backoff=admission_options["shed_backoff"]
+            )
         self.yt_apis = YoutubeApis()
         if options["youtube_oauth"] is not None:
             self.yt_apis.auth_oauth(self.options["youtube_oauth"]["token_file"], self.options["youtube_oauth"]["secrets_file"], reset_oauth)
         if self.options["ffmpeg_log_dir"]:
+            # logs are per restream and size rotated so recent previous runs are kept
             try:
                 os.mkdir(self.options["ffmpeg_log_dir"])
             except FileExistsError:
                 pass
-            remove_dir_contents(self.options["ffmpeg_log_dir"])
+            # logs from before they were per restream grew without limit and aren't matched by pruning
+            for old_log in glob.glob(os.path.join(self.options["ffmpeg_log_dir"], "ffmpeg-*.log*")):
+                try:
+                    os.remove(old_log)
+                except OSError:
+                    pass
+            self.__prune_ffmpeg_logs()
+
+    def __prune_ffmpeg_logs(self):
+        if self.options["ffmpeg_log_dir"]:
+            prune_log_dir(self.options["ffmpeg_log_dir"], self.options["ffmpeg_log_keep_restreams"])
+
+    # Notifications also come for streams that are only scheduled, keep searching often
+    # until they go live or their scheduled start has passed
+    def __add_pending_videos(self, video_ids):
+        for video_id in video_ids:
+            deadline = time() + self.options["websub"]["pending_timeout"]
+            if self.yt_apis.is_authorized():
+                try:
+                    broadcast_content, scheduled_start = self.yt_apis.get_live_schedule(video_id)
+                except (GoogleApis.HttpException, GoogleApis.NetworkException) as e:
+                    logging.warning(e)
+                else:
+                    if broadcast_content == "none":
+                        # a regular upload or a stream that already ended
+                        continue
+                    if scheduled_start is not None:
+                        deadline = max(time(), scheduled_start) + self.options["websub"]["pending_grace"]
+            logging.info(f"Watching notified video '{video_id}' until it goes live")
+            self.pending_videos[video_id] = deadline
+
+    def __update_pending_videos(self, livestreams):
+        for livestream in livestreams:
+            self.pending_videos.pop(livestream.id, None)
+        now = time()
+        for video_id, deadline in list(self.pending_videos.items()):
+            if deadline < now:
+                logging.info(f"Notified video '{video_id}' didn't go live, no longer watching it")
+                self.pending_videos.pop(video_id)
 
     def __format_restream_field(self, live_broadcast, placeholder):
         # TODO find a cleaner way to do this
         return placeholder.replace("{title}", live_broadcast.title).replace("{url}", live_broadcast.url).replace("{channel_name}", live_broadcast.channel_name).replace("{channel_url}", live_broadcast.channel_url)
 
-    def __end_restream(self, rtmp_restream):
+    # one restream per process, the key stays the same when the source is switched
+    def __admission_key(self):
+        return str(os.getpid())
+
+    def __bitrate(self, source_stream):
+        if source_stream.bitrate is None:
+            return self.options["admission"]["bitrate_estimate"]
+        return source_stream.bitrate
+
+    def __admit(self, source_stream):
+        if self.admission is None:
+            return True
+        return self.admission.try_admit(self.__admission_key(), self.options["priority"], self.__bitrate(source_stream))
+
+    # false if the host's limits would never let it in so there's no point queueing
+    def __can_fit(self, source_stream):
+        return self.admission is None or self.admission.can_fit(self.__bitrate(source_stream))
+
+    def __end_restream(self, rtmp_restream, finished=True):
         rtmp_restream.stop()
-        self.finished_stream_ids.append(rtmp_restream.stream_id)
+        if self.admission is not None:
+            self.admission.release(self.__admission_key())
+        if finished:
+            self.finished_stream_ids.append(rtmp_restream.stream_id)
         logging.info(f"Ended restream of '{rtmp_restream.stream_id}'")
 
+    def __create_restream(self, source_stream, rtmp_server, service):
+        rtmp_restream = None
+        logging.info("Creating restream")
+        stream_m3u8_ellipsized = ellipsize(source_stream.m3u8_url, 75)
+        restream_delay = self.options["restream_poll_interval"] - self.options["restream_delay_diff"]
+        logging.info(f"m3u8 '{stream_m3u8_ellipsized}'")
+
+        if rtmp_server is not None:
+            logging.info(f"Using service '{service}'")
+            rtmp_restream = RtmpRestream(rtmp_server, 
+                self.options["stream_file_name"], 
+                source_stream.m3u8_url, source_stream.id, 
+                log_dir=self.options["ffmpeg_log_dir"],
+                ffmpeg_bin=self.options["ffmpeg_bin"],
+                ffprobe_bin=self.options["ffprobe_bin"],
+                delay=restream_delay,
+                catchup_rate=self.options["restream_catchup_rate"],
+                catchup_max_lag=self.options["restream_catchup_max_lag"],
+                log_max_bytes=self.options["ffmpeg_log_max_bytes"],
+                log_backup_count=self.options["ffmpeg_log_backup_count"],
+                log_tail_lines=self.options["ffmpeg_log_tail_lines"],
+                switchover=self.options["restream_switchover"],
+                slate_file=self.options["restream_slate_file"],
+                encoding=self.options["restream_switchover_encoding"]
+            )
+        else:
+            # TODO create a separate object to keep track of a broadcast
+            logging.info("Using OAuth YouTube account")
+            # Youtube max title length is 100
+            broadcast_title = ellipsize(self.__format_restream_field(source_stream, self.options["restream_title_format"]), 100)
+            broadcast_desc = self.__format_restream_field(source_stream, self.options["restream_description_format"])
+            try:
+                with self.tracer.span("create_broadcast"):
+                    broadcast = self.yt_apis.create_rtmp_broadcast(broadcast_title, broadcast_desc, self.options["restream_privacy"])
+                broadcast_id = broadcast["video_id"]
+                server = RtmpServer(broadcast["rtmp_url"], broadcast["rtmp_key"])
+                logging.info(f"Created broadcast at 'https://www.youtube.com/watch?v={broadcast_id}'")
+                rtmp_restream = YoutubeRestream(self.yt_apis, 
+                    broadcast_id, 
+                    server, 
+                    self.options["stream_file_name"], 
+                    source_stream.m3u8_url, 
+                    source_stream.id, 
+                    log_dir=self.options["ffmpeg_log_dir"],
+                    ffmpeg_bin=self.options["ffmpeg_bin"],
+                    ffprobe_bin=self.options["ffprobe_bin"],
+                    delay=restream_delay,
+                    catchup_rate=self.options["restream_catchup_rate"],
+                    catchup_max_lag=self.options["restream_catchup_max_lag"],
+                    log_max_bytes=self.options["ffmpeg_log_max_bytes"],
+                    log_backup_count=self.options["ffmpeg_log_backup_count"],
+                    log_tail_lines=self.options["ffmpeg_log_tail_lines"],
+                    switchover=self.options["restream_switchover"],
+                    slate_file=self.options["restream_slate_file"],
+                    encoding=self.options["restream_switchover_encoding"]
+                )
+            except GoogleApis.NetworkException as e:
+                logging.error(e)
+            except GoogleApis.HttpException as e:
+                logging.critical(e)
+                raise Restreamer.RestreamerException("Unable to create new broadcasts, livestreaming is probably disabled on your account")
+        return rtmp_restream
+
     def restream(self, service="youtube"):
         try:
             os.remove(self.options["stream_file_name"])
@@ -93,11 +311,38 @@ class Restreamer():
             service_dict = self.options["services"][service]
             rtmp_server = RtmpServer(service_dict["rtmp_url"], service_dict["rtmp_key"])
         
+        if self.options["websub"] is not None:
+            websub_options = self.options["websub"]
+            self.websub = WebSubReceiver([self.options["channel_id"]], websub_options["callback_url"],
+                host=websub_options["host"],
+                port=websub_options["port"],
+                hub_url=websub_options["hub_url"],
+                lease_seconds=websub_options["lease_seconds"],
+                secret=websub_options["secret"]
+            )
+            self.websub.start()
+
         rtmp_restream = None
+        # source stream of rtmp_restream
+        restream_source = None
+        queued_stream = None
+        # upload ffmpeg thread whose first frame has been traced already
+        traced_upload = None
         search_interval_c = self.options["youtube_search_interval"]
         try:
             # Event loop
             while True:
+                iteration_start = monotonic()
+                # With push notifications polling is only a fallback
+                search_interval = self.options["youtube_search_interval"]
+                if self.websub is not None:
+                    notified_videos = self.websub.pop_notifications(self.options["channel_id"])
+                    if len(notified_videos) > 0:
+                        self.__add_pending_videos(notified_videos)
+                        search_interval_c = search_interval
+                    elif len(self.pending_videos) == 0 and self.websub.is_subscribed(self.options["channel_id"]):
+                        search_interval = self.options["websub"]["fallback_search_interval"]
+
                 # Check that stream is still alive
                 if rtmp_restream is not None:
                     rtmp_restream_running = False
@@ -106,21 +351,37 @@ class Restreamer():
                     except RtmpRestream.PollException as e:
                         logging.error(e)
                     
+                    upload_connect = rtmp_restream.get_upload_connect()
+                    if upload_connect is not None and upload_connect[0] is not traced_upload:
+                        traced_upload, connect_seconds, first_frame = upload_connect
+                        self.tracer.record("ffmpeg_connect", connect_seconds)
+                        self.tracer.end("detected_to_first_frame", first_frame)
+
                     if not rtmp_restream_running:
                         self.__end_restream(rtmp_restream)
                         rtmp_restream = None
+                    elif self.admission is not None and self.admission.should_shed(self.__admission_key()):
+                        logging.warning(f"Stopping restream of '{rtmp_restream.stream_id}' to make room for higher priority restreams")
+                        # queued again straight away, the next search could be fallback_search_interval away
+                        self.__end_restream(rtmp_restream, finished=False)
+                        rtmp_restream = None
+                        queued_stream = restream_source
 
                 # Get livestreams list
-                if search_interval_c >= self.options["youtube_search_interval"]:
+                if search_interval_c >= search_interval:
                     search_interval_c = 0
                     logging.info(f"Fetching livestreams for channel '{self.options['channel_id']}'")
                     livestreams = None
                     try:
-                        livestreams = self.yt_apis.search_livebroadcasts(self.options["channel_id"])
+                        with self.tracer.span("search"):
+                            livestreams = self.yt_apis.search_livebroadcasts(self.options["channel_id"])
                     except GoogleApis.NetworkException as e:
                         logging.error(e)
                         logging.warning("If you are getting 404 errors the channel_id is probably invalid")
 
+                    if livestreams is not None:
+                        self.__update_pending_videos(livestreams)
+
                     if livestreams is None:
                         pass
                     elif len(livestreams) > 0:
@@ -135,8 +396,21 @@ class Restreamer():
                                     break
                             if not restream_found:
                                 logging.warning("Source stream id changed")
-                                self.__end_restream(rtmp_restream)
-                                rtmp_restream = None
+                                source_stream = livestreams[0]
+                                if self.options["restream_switchover"] and source_stream.id not in self.finished_stream_ids:
+                                    # Keep the rtmp connection and broadcast, only the download changes
+                                    self.finished_stream_ids.append(rtmp_restream.stream_id)
+                                    try:
+                                        rtmp_restream.switch_source(source_stream.m3u8_url, source_stream.id)
+                                        restream_source = source_stream
+                                        self.__prune_ffmpeg_logs()
+                                    except RtmpRestream.SwitchException as e:
+                                        logging.error(e)
+                                        self.__end_restream(rtmp_restream)
+                                        rtmp_restream = None
+                                else:
+                                    self.__end_restream(rtmp_restream)
+                                    rtmp_restream = None
                         else:
                             source_stream = livestreams[0]
                             logging.info(f"Found source stream '{source_stream.id}'")
@@ -144,85 +418,102 @@ class Restreamer():
                             # Don't recreate source streams that timed out
                             if source_stream.id in self.finished_stream_ids:
                                 logging.info(f"Source stream '{source_stream.id}' already used in a restream, skipping")
-
+                                self.tracer.cancel("admission_queue")
+                                queued_stream = None
                             else:
-                                logging.info("Creating restream")
-                                stream_m3u8_ellipsized = ellipsize(source_stream.m3u8_url, 75)
-                                restream_delay = self.options["restream_poll_interval"] - self.options["restream_delay_diff"]
-                                logging.info(f"m3u8 '{stream_m3u8_ellipsized}'")
-
-                                if rtmp_server is not None:
-                                    logging.info(f"Using service '{service}'")
-                                    rtmp_restream = RtmpRestream(rtmp_server, 
-                                        self.options["stream_file_name"], 
-                                        source_stream.m3u8_url, source_stream.id, 
-                                        log_dir=self.options["ffmpeg_log_dir"],
-                                        ffmpeg_bin=self.options["ffmpeg_bin"],
-                                        ffprobe_bin=self.options["ffprobe_bin"],
-                                        delay=restream_delay
-                                    )
-                                else:
-                                    # TODO create a separate object to keep track of a broadcast
-                                    logging.info("Using OAuth YouTube account")
-                                    # Youtube max title length is 100
-                                    broadcast_title = ellipsize(self.__format_restream_field(source_stream, self.options["restream_title_format"]), 100)
-                                    broadcast_desc = self.__format_restream_field(source_stream, self.options["restream_description_format"])
-                                    try:
-                                        broadcast = self.yt_apis.create_rtmp_broadcast(broadcast_title, broadcast_desc, self.options["restream_privacy"])
-                                        broadcast_id = broadcast["video_id"]
-                                        server = RtmpServer(broadcast["rtmp_url"], broadcast["rtmp_key"])
-                                        logging.info(f"Created broadcast at 'https://www.youtube.com/watch?v={broadcast_id}'")
-                                        rtmp_restream = YoutubeRestream(self.yt_apis, 
-                                            broadcast_id, 
-                                            server, 
-                                            self.options["stream_file_name"], 
-                                            source_stream.m3u8_url, 
-                                            source_stream.id, 
-                                            log_dir=self.options["ffmpeg_log_dir"],
-                                            ffmpeg_bin=self.options["ffmpeg_bin"],
-                                            ffprobe_bin=self.options["ffprobe_bin"],
-                                            delay=restream_delay
-                                        )
-                                    except GoogleApis.NetworkException as e:
-                                        logging.error(e)
-                                    except GoogleApis.HttpException as e:
-                                        logging.critical(e)
-                                        raise Restreamer.RestreamerException("Unable to create new broadcasts, livestreaming is probably disabled on your account")
-
-                                if rtmp_restream is not None:
-                                    rtmp_restream.start()
-                                logging.info(f"Successfully began restreaming")
+                                if queued_stream is None or queued_stream.id != source_stream.id:
+                                    # how long the search interval (or notification) took to notice the source
+                                    if source_stream.start_time is not None:
+                                        self.tracer.record("live_to_detected", max(0, time() - source_stream.start_time))
+                                    self.tracer.cancel("detected_to_first_frame")
+                                    self.tracer.start("detected_to_first_frame")
+                                    # a different source has to wait for admission from now
+                                    self.tracer.cancel("admission_queue")
+                                queued_stream = source_stream
 
                     else:
                         logging.info("No source streams found")
+                        self.tracer.cancel("admission_queue")
+                        queued_stream = None
                         if rtmp_restream is not None:
                             self.__end_restream(rtmp_restream)
                             rtmp_restream = None
-                    
+
+                # Start restreaming the found source stream once the host has room for it
+                if queued_stream is not None and rtmp_restream is None:
+                    if not self.__can_fit(queued_stream):
+                        logging.error(f"Restream of '{queued_stream.id}' ({self.__bitrate(queued_stream)}kbps) can never fit within the 'admission' limits, refusing it")
+                        self.finished_stream_ids.append(queued_stream.id)
+                        self.tracer.cancel("admission_queue")
+                        self.tracer.cancel("detected_to_first_frame")
+                        queued_stream = None
+                    elif self.__admit(queued_stream):
+                        self.tracer.end("admission_queue")
+                        rtmp_restream = self.__create_restream(queued_stream, rtmp_server, service)
+                        restream_source = queued_stream
+                        if rtmp_restream is not None:
+                            # includes the fixed start delay
+                            with self.tracer.span("restream_start"):
+                                rtmp_restream.start()
+                            self.__prune_ffmpeg_logs()
+                            logging.info(f"Successfully began restreaming")
+                        else:
+                            self.tracer.cancel("detected_to_first_frame")
+                            if self.admission is not None:
+                                self.admission.release(self.__admission_key())
+                        queued_stream = None
+                    elif self.options["admission"]["queue"]:
+                        if not self.tracer.is_open("admission_queue"):
+                            logging.info(f"Host saturated, queueing restream of '{queued_stream.id}'")
+                        self.tracer.start("admission_queue")
+                    else:
+                        logging.warning(f"Host saturated, refusing restream of '{queued_stream.id}'")
+                        self.finished_stream_ids.append(queued_stream.id)
+                        self.tracer.cancel("detected_to_first_frame")
+                        queued_stream = None
+
+                self.tracer.record("loop_iteration", monotonic() - iteration_start)
+                self.tracer.maybe_write()
                 search_interval_c += self.options["restream_poll_interval"]
-                sleep(self.options["restream_poll_interval"])
+                if self.websub is None:
+                    sleep(self.options["restream_poll_interval"])
+                else:
+                    # wake up early to check a channel as soon as it's notified
+                    self.websub.wait(self.options["restream_poll_interval"])
 
         except KeyboardInterrupt as e:
             if rtmp_restream is not None:
                 self.__end_restream(rtmp_restream)
                 rtmp_restream = None
+            if self.websub is not None:
+                self.websub.stop()
+                self.websub = None
+            self.tracer.write()
             raise e  
 
     def end_broadcasts(self):
-        broadcasts = self.yt_apis.list_broadcast()
         logging.info(f"Attempting to end all active broadcasts")
-        # For some reason broadcasts remain for a short while after completing
-        # TODO check if they're 'complete' first
-        transitions_total = len(broadcasts)
+        # Only live/testing broadcasts are listed so ones that already completed aren't retried
+        broadcasts = self.yt_apis.list_broadcast("active")
+        broadcast_ids = [broadcast.get("id") for broadcast in broadcasts]
+        transitions_total = len(broadcast_ids)
+        if transitions_total == 0:
+            logging.info("No active broadcasts found")
+            return True
+
+        logging.info(f"Ending {transitions_total} broadcasts")
+        results = self.yt_apis.transition_broadcasts(broadcast_ids, "complete",
+            batch_size=self.options["broadcast_batch_size"],
+            max_workers=self.options["broadcast_batch_workers"]
+        )
         transitions_failed = 0
-        for broadcast in broadcasts:
-            broadcast_id = broadcast.get("id")
-            logging.info(f"Ending broadcast '{broadcast_id}'")
-            try:
-                self.yt_apis.transition_broadcast(broadcast_id, "complete")
-            except GoogleApis.HttpException:
+        for broadcast_id in broadcast_ids:
+            error = results.get(broadcast_id)
+            if error is None:
+                logging.info(f"Ended broadcast '{broadcast_id}'")
+            else:
                 transitions_failed += 1
-                logging.warning("->Failed")
+                logging.warning(f"Failed to end broadcast '{broadcast_id}': {error}")
         logging.info(f"{transitions_total - transitions_failed}/{transitions_total} successfully ended")
 
         # Return false if all transitions failed
@@ -235,6 +526,8 @@ def main():
     parser.add_argument("--reset-oauth", action="store_true", dest="reset_oauth", help="Ignore any saved OAuth tokens")
     parser.add_argument("--end-broadcasts", action="store_true", dest="end_broadcasts", help="End all YouTube live broadcasts")
     parser.add_argument("--quiet", action="store_true", help="Don't print any output")
+    parser.add_argument("--profile", action="store_true", help="Profile the control loop with cProfile")
+    parser.add_argument("--profile-file", default="restreamer.prof", dest="profile_file", metavar="FILE", help="Where --profile saves its stats (default restreamer.prof)")
     parser.add_argument("--log-level", choices=LoggingLevel.LEVELS_KEYS, default=None, dest="log_level", help="Set logging level")
 
     args = parser.parse_args()
@@ -255,6 +548,13 @@ def main():
 
     if args.end_broadcasts:
         restreamer.end_broadcasts()
+    elif args.profile:
+        profile = cProfile.Profile()
+        try:
+            profile.runcall(restreamer.restream, args.service)
+        finally:
+            profile.dump_stats(args.profile_file)
+            logging.info(f"Saved profile to '{args.profile_file}', view with 'python -m pstats {args.profile_file}'")
     else:
         restreamer.restream(args.service)
 